@@ -1,17 +1,94 @@
+from collections import OrderedDict
+from copy import deepcopy
+from threading import Lock
+
 import psycopg
 from psycopg import sql
-from psycopg.rows import dict_row
+from psycopg.rows import class_row
+from psycopg_pool import ConnectionPool
 
 from .errors import ClientNotExistsError
 from .model import Client
 from .types import ContactValues, ClientSearchValues
 
 
+# Maximal number of clients cached by a client manager.
+CLIENT_CACHE_SIZE = 1024
+
+# Base query to select clients along with their phone numbers, which
+# are aggregated into sorted arrays. It needs WHERE and GROUP BY clauses
+# to be appended.
+_CLIENT_SELECT = """
+    SELECT c.*, COALESCE(
+            array_agg(cpn.phone_number ORDER BY cpn.phone_number)
+                FILTER (WHERE cpn.phone_number IS NOT NULL),
+            '{}') AS phone_numbers
+        FROM client c
+        LEFT JOIN client_phone_number cpn USING (client_id)"""
+
+# Immutable parts of the client search query, which are built once and
+# then just composed on every search.
+_SEARCH_SELECT = sql.SQL(_CLIENT_SELECT + ' WHERE ')
+_SEARCH_GROUP = sql.SQL(' GROUP BY c.client_id ORDER BY c.client_id;')
+_SEARCH_AND = sql.SQL(' AND ')
+
+# Search conditions by field. Client fields are compared in lower case,
+# so that expression indexes on them can be used. Phone numbers are
+# filtered in a subquery, otherwise only matching phone numbers would be
+# loaded.
+_SEARCH_CONDITIONS = {
+    field: sql.SQL('lower(') + sql.Identifier('c', field) + sql.SQL(') LIKE lower(%s)')
+    for field in ('first_name', 'last_name', 'email')
+}
+_SEARCH_CONDITIONS['phone_number'] = (
+    sql.SQL('EXISTS (SELECT 1 FROM client_phone_number pn '
+            'WHERE pn.client_id = c.client_id AND ')
+    + sql.Identifier('pn', 'phone_number')
+    + sql.SQL(' ILIKE %s)'))
+
+
 class ClientManager:
     """Manages client records"""
 
-    def __init__(self, conn: psycopg.Connection):
-        self.conn = conn
+    def __init__(self, pool: ConnectionPool):
+        """Initializes client manager
+
+        Every method takes its own connection from the pool, so the
+        manager can be used by several concurrent callers. Each method
+        runs in a single transaction, which is committed (or rolled
+        back on errors) once, when the method completes.
+
+        Loaded clients are cached, and the cache is invalidated by the
+        manager's own write methods. Therefore, changes made to client
+        tables bypassing the manager may not be seen by `load_client()`.
+
+        Args:
+            pool: Database connection pool.
+
+        """
+        self.pool = pool
+        # LRU cache of loaded clients, keyed by client ID.
+        self._cache: OrderedDict[int, Client] = OrderedDict()
+        self._cache_lock = Lock()
+        # Cache generation, which is bumped on every invalidation. A
+        # client is only cached if no invalidation happened since it
+        # started loading, otherwise it could be stale.
+        self._cache_generation = 0
+
+    @staticmethod
+    def configure(conn: psycopg.Connection):
+        """Configures a new pooled connection
+
+        Meant to be passed as `configure` callback to the connection
+        pool. Makes psycopg prepare queries on the server since their
+        second execution, as the manager runs the same queries over and
+        over again.
+
+        Args:
+            conn: Database connection.
+
+        """
+        conn.prepare_threshold = 1
 
 
     def setup(self):
@@ -27,7 +104,7 @@ class ClientManager:
 
     def ensure_tables(self):
         """Softly creates client tables"""
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             # Main client table contains first name, last (family) name
             # and email address.
             cur.execute("""
@@ -40,27 +117,68 @@ class ClientManager:
 
             # Client phone number table contains phone numbers attached
             # to clients. It doesn't have primary key, as it's just not
-            # needed here. If we required unique phone numbers, then
-            # `phone_number` column itself could be a primary key, but
-            # I'm quite sure that such conditions should be implemented
-            # on the code level, not on the DB level.
+            # needed here. Different clients may share a phone number,
+            # but a single client may not have duplicate ones (see the
+            # unique index below).
             cur.execute("""
                 CREATE TABLE IF NOT EXISTS client_phone_number (
                     client_id INTEGER NOT NULL REFERENCES client(client_id) ON DELETE CASCADE,
                     phone_number VARCHAR(20));
                 """)
 
-            self.conn.commit()
+            # Keep client phone numbers unique, so that the table
+            # doesn't grow with duplicates. The index also serves phone
+            # number lookups (and cascade deletes) by client ID. Tables
+            # created before the index was introduced may already have
+            # duplicates, which must be removed before creating it.
+            cur.execute("SELECT to_regclass('uq_cpn_client_id_phone_number');")
+            if cur.fetchone()[0] is None:
+                cur.execute("""
+                    DELETE FROM client_phone_number a
+                        USING client_phone_number b
+                        WHERE a.client_id = b.client_id
+                            AND a.phone_number = b.phone_number
+                            AND a.ctid > b.ctid;
+                    """)
+                cur.execute("""
+                    CREATE UNIQUE INDEX IF NOT EXISTS uq_cpn_client_id_phone_number
+                        ON client_phone_number (client_id, phone_number);
+                    """)
+
+            # Clients are searched by lower-cased names and emails with
+            # arbitrary LIKE patterns, which only trigram indexes can
+            # speed up. Phone numbers are searched as is with ILIKE.
+            cur.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm;')
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_client_first_name_lower_trgm
+                    ON client USING gin (lower(first_name) gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_client_last_name_lower_trgm
+                    ON client USING gin (lower(last_name) gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_client_email_lower_trgm
+                    ON client USING gin (lower(email) gin_trgm_ops);
+                CREATE INDEX IF NOT EXISTS idx_cpn_phone_number_trgm
+                    ON client_phone_number USING gin (phone_number gin_trgm_ops);
+                """)
+
+            # Searches by name prefixes (the most typical ones) can also
+            # use a B-tree index. Pattern operator classes are needed for
+            # LIKE to use it regardless of the database collation.
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_client_name_lower
+                    ON client (lower(first_name) text_pattern_ops, lower(last_name) text_pattern_ops);
+                """)
 
     def drop_tables(self):
         """Drops all client tables"""
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute("""
                 DROP TABLE IF EXISTS client_phone_number;
                 DROP TABLE IF EXISTS client;
                 """)
 
-            self.conn.commit()
+        with self._cache_lock:
+            self._cache.clear()
+            self._cache_generation += 1
 
 
     def add_client(self, values: ContactValues) -> Client:
@@ -70,25 +188,43 @@ class ClientManager:
             values: Client data to be added.
 
         """
-        with self.conn.cursor() as cur:
-            # Add the main client record.
+        phone_numbers = values.get('phone_numbers') or []
+        generation = self._cache_generation
+        with (
+            self.pool.connection() as conn,
+            conn.transaction(),
+            conn.cursor(row_factory=class_row(Client), binary=True) as cur
+        ):
+            # Add the main client record and client phone numbers (if
+            # any) in a single query, as phone numbers can take the new
+            # client ID right from the first CTE.
             cur.execute(
                 """
-                INSERT INTO client (first_name, last_name, email)
-                    VALUES (%s, %s, %s) RETURNING client_id;
+                WITH ins AS (
+                    INSERT INTO client (first_name, last_name, email)
+                        VALUES (%s, %s, %s) RETURNING *
+                ), ins_phone AS (
+                    INSERT INTO client_phone_number
+                        SELECT client_id, unnest(%s::varchar[]) FROM ins
+                        ON CONFLICT DO NOTHING
+                )
+                SELECT * FROM ins;
                 """,
                 (
                     values.get('first_name'),
                     values.get('last_name'),
-                    values.get('email')
+                    values.get('email'),
+                    phone_numbers
                 ))
-            (client_id,) = cur.fetchone()
-
-        # Add client phone numbers, if any.
-        self._add_phone_numbers(client_id, values.get('phone_numbers'))
+            client = cur.fetchone()
 
-        # Return the newly added client.
-        return self.load_client(client_id)
+        # Return the newly added client. There is no need to load its
+        # phone numbers from the database, as they are already known
+        # (except for duplicates, which are skipped). Phone numbers are
+        # sorted, just like when they are loaded.
+        client.phone_numbers = sorted(dict.fromkeys(phone_numbers))
+        self._cache_client(client, generation)
+        return client
 
     def load_client(self, client_id: int) -> Client | None:
         """Loads and returns client instance given its ID
@@ -97,19 +233,31 @@ class ClientManager:
             client_id: Client ID.
 
         """
-        with self.conn.cursor(row_factory=dict_row) as cur:
-            # Fetch base client data as a dict.
+        with self._cache_lock:
+            if client_id in self._cache:
+                self._cache.move_to_end(client_id)
+                # Return a copy, so that the cached client is not
+                # affected by changes made by the caller.
+                return deepcopy(self._cache[client_id])
+            generation = self._cache_generation
+
+        # Clients are fetched in binary format, which is cheaper to
+        # transfer and parse than text, especially for arrays.
+        with (
+            self.pool.connection() as conn,
+            conn.cursor(row_factory=class_row(Client), binary=True) as cur
+        ):
+            # Fetch client data along with its phone numbers right into
+            # a client instance.
             cur.execute(
-                'SELECT * FROM client WHERE client_id = %s;',
+                _CLIENT_SELECT + ' WHERE c.client_id = %s GROUP BY c.client_id;',
                 (client_id,)
             )
-            if data := cur.fetchone():
-                client = Client(data)
-                # Add client phone numbers.
-                client.phone_numbers = self._load_phone_numbers(client_id)
-                return client
+            client = cur.fetchone()
 
-        return None
+        if client:
+            self._cache_client(client, generation)
+        return client
 
     def load_clients(self, client_ids: list[int]) -> dict[int, Client] | None:
         """Loads and returns client instances given their IDs
@@ -119,23 +267,22 @@ class ClientManager:
 
         """
         if client_ids:
-            with self.conn.cursor(row_factory=dict_row) as cur:
-                # Fetch base clients data as a list of dicts.
-                cur.execute(
-                    'SELECT * FROM client WHERE client_id = ANY(%s);',
+            with (
+                self.pool.connection() as conn,
+                conn.cursor(row_factory=class_row(Client), binary=True) as cur
+            ):
+                # Stream clients data along with their phone numbers
+                # aggregated into arrays, so that rows are processed as
+                # soon as they arrive instead of being buffered first.
+                rows = cur.stream(
+                    _CLIENT_SELECT + """
+                        WHERE c.client_id = ANY(%s)
+                        GROUP BY c.client_id
+                        ORDER BY c.client_id;
+                    """,
                     (client_ids,)
                 )
-                clients = {item['client_id']: Client(item) for item in cur.fetchall()}
-
-                # Fetch all phone numbers at once for performance reasons.
-                cur.execute(
-                    'SELECT * FROM client_phone_number WHERE client_id = ANY(%s);',
-                    (client_ids,)
-                )
-                for item in cur.fetchall():
-                    client_id = item['client_id']
-                    if client_id in clients:
-                        clients[client_id].phone_numbers.append(item['phone_number'])
+                clients = {client.id: client for client in rows}
 
             return clients
 
@@ -146,31 +293,42 @@ class ClientManager:
             client: Client instance to update.
 
         """
-        with self.conn.cursor() as cur:
-            # Update base client data.
-            cur.execute(
-                """
-                UPDATE client 
-                    SET first_name = %s, last_name = %s, email = %s
-                    WHERE client_id = %s
-                    RETURNING client_id;
-                """,
-                (
-                    client.first_name,
-                    client.last_name,
-                    client.email,
-                    client.id
-                ))
+        # Client data and phone numbers are updated in one transaction,
+        # which is rolled back if the client doesn't exist.
+        with self.pool.connection() as conn, conn.transaction(), conn.cursor() as cur:
+            # All the queries are sent in a single pipeline, without
+            # waiting for the client update to complete. Phone number
+            # queries are no-op if the client doesn't exist.
+            with conn.pipeline():
+                # Update base client data.
+                cur.execute(
+                    """
+                    UPDATE client 
+                        SET first_name = %s, last_name = %s, email = %s
+                        WHERE client_id = %s;
+                    """,
+                    (
+                        client.first_name,
+                        client.last_name,
+                        client.email,
+                        client.id
+                    ))
 
-            if cur.fetchone():
                 # Update client phone numbers.
-                self._set_phone_numbers(client.id, client.phone_numbers)
+                self._set_phone_numbers(conn, client.id, client.phone_numbers)
 
-                # Return updated client.
-                return self.load_client(client.id)
-            else:
+            if cur.rowcount == 0:
                 raise ClientNotExistsError(f'Client with ID={client.id} does not exist')
 
+        self._uncache_client(client.id)
+
+        # Return updated client: it's already in sync with the database,
+        # so there is no need to reload it (except for duplicate phone
+        # numbers, which are skipped). Phone numbers are sorted, just
+        # like when they are loaded.
+        client.phone_numbers = sorted(dict.fromkeys(client.phone_numbers))
+        return client
+
     def delete_client(self, client_id: int):
         """Deletes client given its ID
 
@@ -178,42 +336,38 @@ class ClientManager:
             client_id: Client ID.
 
         """
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute(
                 'DELETE FROM client WHERE client_id = %s;',
                 (client_id,))
 
+        self._uncache_client(client_id)
+
     def search_clients(self, values: ClientSearchValues) -> dict[int, Client] | None:
         """Searches for clients
 
-        Note that this method uses ILIKE for search, so any placeholder
-        values including "%" will work as expected.
+        Note that this method uses case-insensitive LIKE for search, so
+        any placeholder values including "%" will work as expected.
 
         Args:
             values: Values to search clients by.
 
         """
         if values:
-            with self.conn.cursor() as cur:
-                # Build a dynamic query to select IDs of clients that
-                # match filter values.
-                query = sql.SQL('SELECT c.client_id FROM client c ')
-                if 'phone_number' in values:
-                    query += sql.SQL('JOIN client_phone_number cpn ON c.client_id = cpn.client_id ')
-                query += sql.SQL('WHERE ')
-                where, params = [], []
-                for field, value in values.items():
-                    table = 'cpn' if field == 'phone_number' else 'c'
-                    where.append(sql.Identifier(table, field) + sql.SQL(' ILIKE %s'))
-                    params.append(value)
-                query += sql.SQL(' AND ').join(where)
-
-                # Query returns list of client IDs.
-                cur.execute(query, params)
-                client_ids = [client_id for client_id, in cur.fetchall()]
+            with (
+                self.pool.connection() as conn,
+                conn.cursor(row_factory=class_row(Client), binary=True) as cur
+            ):
+                # Build a dynamic query to select clients that match
+                # filter values along with all their phone numbers.
+                where = _SEARCH_AND.join(_SEARCH_CONDITIONS[field] for field in values)
+                query = _SEARCH_SELECT + where + _SEARCH_GROUP
+                params = list(values.values())
 
-                return self.load_clients(client_ids)
+                cur.execute(query, params)
+                clients = {client.id: client for client in cur.fetchall()}
 
+            return clients or None
 
     def add_phone_number(self, client_id: int, phone_number: str) -> Client:
         """Adds single client phone number
@@ -223,11 +377,10 @@ class ClientManager:
             phone_number: Phone number to add.
 
         """
-        with self.conn.cursor() as cur:
-            cur.execute(
-                'INSERT INTO client_phone_number VALUES(%s, %s);',
-                (client_id, phone_number))
-            self.conn.commit()
+        with self.pool.connection() as conn:
+            self._add_phone_numbers(conn, client_id, [phone_number])
+
+        self._uncache_client(client_id)
 
         # Return updated client instance.
         return self.load_client(client_id)
@@ -240,7 +393,7 @@ class ClientManager:
             phone_number: Phone number to delete.
 
         """
-        with self.conn.cursor() as cur:
+        with self.pool.connection() as conn, conn.cursor() as cur:
             cur.execute(
                 """
                 DELETE FROM client_phone_number 
@@ -248,65 +401,113 @@ class ClientManager:
                 """,
                 (client_id, phone_number))
 
+        self._uncache_client(client_id)
+
         # Return updated client instance.
         return self.load_client(client_id)
 
 
-    def _add_phone_numbers(self, client_id: int, phone_numbers: list[str]):
+    def _cache_client(self, client: Client, generation: int):
+        """Puts a copy of client instance to the cache
+
+        The client is not cached if the cache has been invalidated
+        since the given generation, as the client might have been
+        changed concurrently after it was loaded. Least recently used
+        clients are evicted from the cache once it grows over
+        `CLIENT_CACHE_SIZE`.
+
+        Args:
+            client: Client instance to cache.
+            generation: Cache generation read before the client was
+                loaded from the database.
+
+        """
+        with self._cache_lock:
+            if generation != self._cache_generation:
+                return
+            self._cache[client.id] = deepcopy(client)
+            self._cache.move_to_end(client.id)
+            if len(self._cache) > CLIENT_CACHE_SIZE:
+                self._cache.popitem(last=False)
+
+    def _uncache_client(self, client_id: int):
+        """Removes client instance from the cache
+
+        Args:
+            client_id: Client ID.
+
+        """
+        with self._cache_lock:
+            self._cache.pop(client_id, None)
+            self._cache_generation += 1
+
+    def _add_phone_numbers(self, conn: psycopg.Connection, client_id: int, phone_numbers: list[str]):
         """Adds a bunch of client phone numbers
 
         Args:
+            conn: Database connection.
             client_id: Client ID.
             phone_numbers: Phone numbers to add.
 
         """
         if phone_numbers:
-            with self.conn.cursor() as cur:
-                for phone_number in phone_numbers:
-                    cur.execute(
-                        'INSERT INTO client_phone_number VALUES(%s, %s);',
-                        (client_id, phone_number))
-                self.conn.commit()
-
-    def _load_phone_numbers(self, client_id: int) -> list[str]:
+            with conn.cursor() as cur:
+                # Insert all the phone numbers with a single statement
+                # by passing them as an array.
+                cur.execute(
+                    """
+                    INSERT INTO client_phone_number (client_id, phone_number)
+                        SELECT %s, unnest(%s::varchar[])
+                        ON CONFLICT DO NOTHING;
+                    """,
+                    (client_id, list(phone_numbers)))
+
+    def _load_phone_numbers(self, conn: psycopg.Connection, client_id: int) -> list[str]:
         """Loads and returns client phone numbers
 
         Args:
+            conn: Database connection.
             client_id: Client ID.
 
         """
-        with self.conn.cursor() as cur:
+        with conn.cursor() as cur:
             cur.execute(
-                'SELECT phone_number FROM client_phone_number WHERE client_id = %s;',
+                """
+                SELECT phone_number FROM client_phone_number
+                    WHERE client_id = %s ORDER BY phone_number;
+                """,
                 (client_id,)
             )
             return [num for num, in cur.fetchall()]
 
-    def _set_phone_numbers(self, client_id: int, phone_numbers: list[str]):
+    def _set_phone_numbers(self, conn: psycopg.Connection, client_id: int, phone_numbers: list[str]):
         """Replaces client's phone numbers
 
         Args:
+            conn: Database connection.
             client_id: Client ID.
             phone_numbers: New set of client phone numbers to replace
                 the old ones.
 
         """
-        # Just delete all client's existing phone numbers and then add
-        # new ones.
-        self._delete_phone_numbers(client_id)
-        self._add_phone_numbers(client_id, phone_numbers)
-
-        # Return updated client instance.
-        return self.load_client(client_id)
-
-    def _delete_phone_numbers(self, client_id: int):
-        """Deletes all client's phone numbers
-
-        Args:
-            client_id: Client ID.
-
-        """
-        with self.conn.cursor() as cur:
+        phone_numbers = list(phone_numbers)
+        # Only touch phone numbers that actually changed: delete the
+        # ones not in the new set and add the ones not yet stored. Note
+        # that nothing is added if the client doesn't exist.
+        with conn.cursor() as cur:
             cur.execute(
-                'DELETE FROM client_phone_number WHERE client_id = %s;',
-                (client_id,))
+                """
+                DELETE FROM client_phone_number
+                    WHERE client_id = %s AND phone_number <> ALL(%s::varchar[]);
+                """,
+                (client_id, phone_numbers))
+            # Phone numbers the client already has are skipped.
+            cur.execute(
+                """
+                INSERT INTO client_phone_number
+                    SELECT c.client_id, unnest(%s::varchar[])
+                        FROM client c
+                        WHERE c.client_id = %s
+                    ON CONFLICT DO NOTHING;
+                """,
+                (phone_numbers, client_id))
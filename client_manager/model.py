@@ -1,15 +1,23 @@
-from .types import ClientValues
-
-
 class Client:
     """Client model"""
 
-    def __init__(self, props: ClientValues):
-        self.id = props.get('client_id')
-        self.first_name = props.get('first_name')
-        self.last_name = props.get('last_name')
-        self.email = props.get('email')
-        self.phone_numbers = props.get('phone_numbers', [])
+    # Clients may be loaded in large numbers, so don't waste memory on
+    # per-instance dicts.
+    __slots__ = ('id', 'first_name', 'last_name', 'email', 'phone_numbers')
+
+    def __init__(
+        self,
+        client_id: int,
+        first_name: str,
+        last_name: str,
+        email: str | None = None,
+        phone_numbers: list[str] | None = None
+    ):
+        self.id = client_id
+        self.first_name = first_name
+        self.last_name = last_name
+        self.email = email
+        self.phone_numbers = phone_numbers if phone_numbers is not None else []
 
     def __str__(self):
         parts = [f'({self.id})', self.first_name, self.last_name]
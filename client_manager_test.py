@@ -1,4 +1,4 @@
-import psycopg
+from psycopg_pool import ConnectionPool
 from pytest import raises
 
 from client_manager import ClientManager
@@ -6,8 +6,13 @@ from client_manager.errors import ClientNotExistsError
 
 def test_client_manager():
     with open('db.txt', encoding='UTF-8') as f:
-        with psycopg.connect(f.readline()) as conn:
-            cm = ClientManager(conn)
+        with ConnectionPool(
+            f.readline(),
+            min_size=4,
+            max_size=20,
+            configure=ClientManager.configure
+        ) as pool:
+            cm = ClientManager(pool)
 
             # Prepare client tables.
             cm.setup()
@@ -31,7 +36,22 @@ def test_client_manager():
             client = cm.delete_phone_number(client.id, '+12222222222')
             assert str(client) == '(1) Michael Keaton <m.keaton@hollywood.com> [+13333333333]'
 
-            # Add another client.
+            # Adding a phone number the client already has changes
+            # nothing.
+            client = cm.add_phone_number(client.id, '+13333333333')
+            assert str(client) == '(1) Michael Keaton <m.keaton@hollywood.com> [+13333333333]'
+            with pool.connection() as conn:
+                assert cm._load_phone_numbers(conn, client.id) == ['+13333333333']
+
+            # Change the loaded client without saving it: the change
+            # mustn't leak into the cache of loaded clients.
+            client = cm.load_client(client.id)
+            client.first_name = 'Mike'
+            client.phone_numbers.append('+14444444444')
+            client = cm.load_client(client.id)
+            assert str(client) == '(1) Michael Keaton <m.keaton@hollywood.com> [+13333333333]'
+
+            # Add another client (duplicate phone numbers are skipped).
             client = cm.add_client({
                 'first_name': 'Bruce',
                 'last_name': 'Dickinson',
@@ -39,9 +59,12 @@ def test_client_manager():
                 'phone_numbers': [
                     '+441111111111',
                     '+442222222222',
+                    '+441111111111',
                 ],
             })
             assert str(client) == '(2) Bruce Dickinson <b.dickinson@ironmaiden.com> [+441111111111, +442222222222]'
+            with pool.connection() as conn:
+                assert cm._load_phone_numbers(conn, client.id) == ['+441111111111', '+442222222222']
 
             # Add one more client.
             client = cm.add_client({
@@ -64,7 +87,8 @@ def test_client_manager():
             # Internal test: after client deletion there shouldn't be
             # any phone numbers related to deleted client left in the
             # database.
-            assert cm._load_phone_numbers(client.id) == []
+            with pool.connection() as conn:
+                assert cm._load_phone_numbers(conn, client.id) == []
 
             # Add a client with just first and last names.
             client = cm.add_client({
@@ -79,11 +103,16 @@ def test_client_manager():
             cm.update_client(client)
             assert str(client) == '(4) Rafael Nadal Parera <r.nadal@rafaelnadal.com>'
 
+            # The update invalidates the cached client, so reloading it
+            # returns the updated data.
+            assert str(cm.load_client(client.id)) == '(4) Rafael Nadal Parera <r.nadal@rafaelnadal.com>'
+
             # Now explicitly set the client's phone numbers.
             client.phone_numbers.append('+341111111111')
             client.phone_numbers.append('+342222222222')
             cm.update_client(client)
             assert str(client) == '(4) Rafael Nadal Parera <r.nadal@rafaelnadal.com> [+341111111111, +342222222222]'
+            assert str(cm.load_client(client.id)) == str(client)
 
             # Try to update client that doesn't exist.
             with raises(ClientNotExistsError) as e:
@@ -142,3 +171,9 @@ def test_client_manager():
             })
             assert clients is None
 
+            # Dropping tables clears the cache as well, so a client that
+            # has just been loaded (and cached) can't be loaded anymore.
+            assert cm.load_client(1) is not None
+            cm.setup()
+            assert cm.load_client(1) is None
+